@@ -11,21 +11,31 @@ Date: 20_05_2021
 #                       IMPORTS
 ############################################################
 
-# implements pseudo-random number generators for various distributions.
-import random
-# access functionalities dependent on the Operating System
-import os
+# keeps binary data (images) in memory as if it was a file
+import io
+# reads the options given when starting the bot
+import sys
+# saves the results of functions to avoid repeating calls
+from functools import lru_cache
 # code and data structures related to the acquisition and storage of graphs
 # corresponding to maps, congestion, and route calculations.
 import igo
-# retrieve, model, analyze, and visualize street networks from OpenStreetMap
-import osmnx as ox
 # connects to Open Street Maps to generate maps with lines and markers
-from staticmap import StaticMap, CircleMarker, Line
+from staticmap import CircleMarker
 # import Telegram's API
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
 # display the current date
 import datetime
+# allows several users to be attended at the same time
+import threading
+# waits between the updates of the congestions
+import time
+# runs independent downloads at the same time
+from concurrent.futures import ThreadPoolExecutor
+# writes messages on the terminal without blocking the users' commands
+import logging
+import logging.handlers
+import queue
 
 ############################################################
 #                CONSTANTS AND VARIABLES
@@ -34,24 +44,96 @@ import datetime
 PLACE = 'Barcelona, Catalonia'
 # Name of the file where we will save the graph
 GRAPH_FILENAME = 'barcelona.graph'
+# Name of the file where we will save the graph with congestions and itimes
+IGRAPH_FILENAME = 'barcelona.igraph'
 # Size of the images that will be saved
 SIZE = 800
 # URL from where we can get data from Barcelona's streets
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 # URL from where we can get data from Barcelona's congestions
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+# Size of the images of the user's location
+LOCATION_SIZE = 500
+# Number of decimals used to round the coordinates of a location (~11 m)
+LOCATION_DECIMALS = 4
+# If the bot is started with --render-map, /where sends a rendered image of
+# the map; otherwise it sends a Telegram location, drawn by the user's app
+RENDER_LOCATION_MAP = '--render-map' in sys.argv
+# Number of threads that attend the users' commands at the same time
+WORKERS = 16
+# Seconds that the bot waits for new messages in every request to Telegram
+POLLING_TIMEOUT = 20
+# Seconds between two updates of the congestions (5 minutes)
+UPDATE_INTERVAL = 300
+
+# Messages the bot sends to the users. The ones with {} are completed with
+# the data of every user
+START_TEMPLATE = ("Hi, {name}! 👋 I am IGo. Click /help and I will let you "
+                  "now which are my main functions.")
+HELP_TEXT = ("I am a bot with commands: \n/start - starts the conversation. "
+             "\n/help - offers help on available orders."
+             "\n/author - shows the name of the project's authors."
+             "\n/where - shows the actual position of the user. This "
+             "function is called every time the user arrives a new "
+             "localitzacion. \n/pos - sets the user's current position to a "
+             "false position.\n/go destination - shows to the user a map to "
+             "get from their current position to destination point chosen "
+             "for the shortest path according to the concept of speed.")
+AUTHOR_TEXT = "🖋️My authors are Valèria Caro Via and Esther Fanyanàs Ropero."
+WHERE_TEMPLATE = "You are in the coordinates {lat:f} {lon:f}"
+NO_LOCATION_TEXT = "💣 Please, first you need to send me your location."
+POS_TEMPLATE = "You are starting the route from {location}📍"
+INVALID_LOCATION_TEXT = "💣 You need to introduce a valid location."
+GO_TEMPLATE = "Let's go! 🚘 The fastest path to go from {location} to {destination} is:"
+ADDRESS_TEMPLATE = "{address}, Barcelona"
+CALCULATING_TEXT = "...Calculating the fastest route... "
+INVALID_ROUTE_TEXT = ("💣 Your destination is incorrect or your location is "
+                      "not valid.")
+
+# The messages for the terminal are put in a queue and written by another
+# thread, so the workers do not wait for each other to write them. The
+# thread is started after building the igraph, which may use fork
+LOG_QUEUE = queue.Queue(-1)
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, logging.StreamHandler())
+log = logging.getLogger('igo')
+log.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+log.setLevel(logging.INFO)
 
 # When starting the program does once:
-# Download graph
-graph = igo.get_graph()
-# Download highways
-highways = igo.download_highways(HIGHWAYS_URL)
-# Download congestions
-congestions = igo.download_congestions(CONGESTIONS_URL)
-# Save the start time of the igraph creation
-START_TIME = datetime.datetime.now()
-# Create a graph with congestion and itime attributes.
-IGRAPH = igo.build_igraph(graph, highways, congestions)
+# Load the igraph saved by the last execution if its congestions are recent
+IGRAPH, START_TIME = igo.load_igraph(
+    IGRAPH_FILENAME, datetime.timedelta(seconds=UPDATE_INTERVAL))
+# Download highways and, if the igraph has to be built, the graph and the
+# congestions at the same time, as they do not depend on each other. The
+# highways are always needed: update_igraph uses them if the saved igraph
+# does not have the edges of every street
+with ThreadPoolExecutor(3) as executor:
+    highways_future = executor.submit(igo.download_highways, HIGHWAYS_URL)
+    if IGRAPH is None:
+        graph_future = executor.submit(igo.get_graph)
+        congestions_future = executor.submit(igo.download_congestions,
+                                             CONGESTIONS_URL)
+    highways = highways_future.result()
+if IGRAPH is None:
+    # Save the start time of the igraph creation. When the igraph is loaded,
+    # it is the time when it was saved, so it is updated on time
+    START_TIME = datetime.datetime.now()
+    graph = graph_future.result()
+    # Build the tree of the nodes of the graph only once: the copies of the
+    # graph used for every igraph share it
+    igo.nodes_tree(graph)
+    congestions = congestions_future.result()
+    # Create a graph with congestion and itime attributes. It is built on a
+    # copy so the original graph is kept clean for the next updates
+    IGRAPH = igo.build_igraph(graph.copy(), highways, congestions)
+    # Save it so the next execution does not need to build it again
+    igo.save_igraph(IGRAPH, IGRAPH_FILENAME)
+# Start writing the messages for the terminal
+LOG_LISTENER.start()
+# Number of the igraph version, it increases every time the igraph is updated
+IGRAPH_VERSION = 0
+# Protects IGRAPH so that it is not read while it is being updated
+IGRAPH_LOCK = threading.Lock()
 
 
 ############################################################
@@ -72,15 +154,12 @@ def start(update, context):
               A message to the terminal indicating who have
               started using IGo.
     ----------------------------------------------------'''
-    # Print on the terminal a message indicating who have started using IGo.
-    print(update.effective_chat.first_name + " is using IGo.")
+    # Write on the terminal a message indicating who have started using IGo.
+    log.info("%s is using IGo.", update.effective_chat.first_name)
     # Send a message greeting the user
-    message = "Hi, " + update.effective_chat.first_name
-    message += "! 👋 I am IGo. Click /help and I will let you now which are "
-    message += "my main functions."
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=message
+        text=START_TEMPLATE.format(name=update.effective_chat.first_name)
         )
 
 
@@ -97,21 +176,12 @@ def help(update, context):
               A message to the terminal indicating that
               help have been requested.
     ---------------------------------------------------'''
-    # Print on the terminal a message to indicate who has requested help
-    print(update.effective_chat.first_name + " is asking for help.")
-
-    message = "I am a bot with commands: \n/start - starts the "
-    message += "conversation. \n/help - offers help on available orders."
-    message += "\n/author - shows the name of the project's authors."
-    message += "\n/where - shows the actual position of the user. This "
-    message += "function is called every time the user arrives a new "
-    message += "localitzacion. \n/pos - sets the user's current position to a "
-    message += "false position.\n/go destination - shows to the user a map to "
-    message += "get from their current position to destination point chosen "
-    message += "for the shortest path according to the concept of speed."
+    # Write on the terminal a message to indicate who has requested help
+    log.info("%s is asking for help.", update.effective_chat.first_name)
+
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text=message
+        text=HELP_TEXT
         )
 
 
@@ -127,12 +197,12 @@ def author(update, context):
               A message to the terminal indicating
               authors have been asked.
     ---------------------------------------------------'''
-    # Print on the terminal a message indicating who has asked for the authors
-    print(update.effective_chat.first_name + " is asking for the authors.")
+    # Write on the terminal a message indicating who has asked for the authors
+    log.info("%s is asking for the authors.", update.effective_chat.first_name)
 
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="🖋️My authors are Valèria Caro Via and Esther Fanyanàs Ropero."
+        text=AUTHOR_TEXT
         )
 
 
@@ -150,9 +220,31 @@ def location(update, context):
     # Take the location coordinates
     lat, lon = update.message.location.latitude, update.message.location.longitude
     context.user_data['location'] = [lat, lon]
-    # Print on the terminal a message to indicate who has requested author
-    print(update.effective_chat.first_name + " is in:")
-    print(context.user_data['location'])
+    # Write on the terminal a message to indicate who has requested author
+    log.info("%s is in: %s", update.effective_chat.first_name,
+             context.user_data['location'])
+
+
+@lru_cache(maxsize=256)
+def render_location_png(lat, lon):
+    '''----------------------------------------------------
+    * Name: render_location_png
+    * Function: Renders a map with a point in the given
+                coordinates. The result is saved in a cache
+                so that the same (or a very near) location
+                is not rendered twice.
+    * Parameters: lat, lon: Rounded coordinates of the
+                  location.
+    * Return: The bytes of a PNG image of the map.
+    ----------------------------------------------------'''
+    # Create a map and put a point in the location coordinates
+    map = igo.CachedStaticMap(LOCATION_SIZE, LOCATION_SIZE)
+    map.add_marker(CircleMarker((lon, lat), 'blue', 10))
+    image = map.render()
+    # Save the image in memory instead of in a file
+    buf = io.BytesIO()
+    image.save(buf, 'PNG', optimize=False, compress_level=igo.PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
 
 
 def where(update, context):
@@ -169,44 +261,62 @@ def where(update, context):
               of the user's current position.
 
     ----------------------------------------------------'''
-    # Print on the terminal a message indicating the user who wants to know
+    # Write on the terminal a message indicating the user who wants to know
     # her/his position
-    message = update.effective_chat.first_name
-    message += " wants to know her/his position."
-    print(message)
+    log.info("%s wants to know her/his position.", update.effective_chat.first_name)
 
     try:
-        if type(context.user_data['location']) == list:
+        if isinstance(context.user_data['location'], (list, tuple)):
             lat, lon = context.user_data['location']
         # If the locations are not given as a list, will force it looks
         # like them.
         else:
             location = context.user_data['location'].replace("(", "[")
             location = location.replace(")", "]")
-            lat, lon = ox.geocode(location)
-        # Create a map and put a point in the location coordinates
-        file = "%d.png" % random.randint(1000000, 9999999)
-        map = StaticMap(500, 500)
-        map.add_marker(CircleMarker((lon, lat), 'blue', 10))
-        image = map.render()
-        image.save(file)
+            lat, lon = igo.geocode(normalize_location(location))
         # Send a message with the location coordinates
         context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text='You are in the coordinates %f %f' % (lat, lon))
-        # Send a map with the location
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(file, 'rb'))
-        os.remove(file)
+            text=WHERE_TEMPLATE.format(lat=lat, lon=lon))
+        if RENDER_LOCATION_MAP:
+            # Get the map of the location (rendered only if it is not cached)
+            png = render_location_png(round(lat, LOCATION_DECIMALS),
+                                      round(lon, LOCATION_DECIMALS))
+            # Send a map with the location
+            context.bot.send_photo(
+                chat_id=update.effective_chat.id,
+                photo=io.BytesIO(png))
+        else:
+            # Send the location, Telegram shows it in a map
+            context.bot.send_location(
+                chat_id=update.effective_chat.id,
+                latitude=lat,
+                longitude=lon)
 
     except Exception as e:
         # In case there is any error with the location or it has not been sent,
         # it will be notified
-        print(e)
+        log.error(e)
         context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text='💣 Please, first you need to send me your location.')
+            text=NO_LOCATION_TEXT)
+
+
+def address_from_args(args):
+    '''---------------------------------------------------
+    * Name: address_from_args
+    * Function: Builds the address of a place in
+                Barcelona from the words written after a
+                command.
+    * Parameters: args: Words written after the command
+                  (context.args).
+    * Return: The address with ", Barcelona" at the end.
+              If no words have been written, raises a
+              ValueError.
+    ---------------------------------------------------'''
+    if not args:
+        raise ValueError("No location has been given.")
+    return ADDRESS_TEMPLATE.format(address=" ".join(args))
 
 
 def pos(update, context):
@@ -224,32 +334,77 @@ def pos(update, context):
               position has been falsified.
     ---------------------------------------------------'''
     try:
-        # Print on the terminal a message indicating the position has been
+        # Write on the terminal a message indicating the position has been
         # falsified
-        message = update.effective_chat.first_name
-        message += " has falsified the position."
-        print(message)
-        # Saves the source location falsified by the user
-        context.user_data['location'] = update.message.text[5:] + ", Barcelona"
+        log.info("%s has falsified the position.", update.effective_chat.first_name)
+        # Saves the source location falsified by the user, taking the words
+        # written after the command
+        context.user_data['location'] = address_from_args(context.args)
         # Send a message saying the new location
-        message2 = "You are starting the route from "
-        message2 += str(context.user_data['location']) + "📍"
         context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=message2
+            text=POS_TEMPLATE.format(location=context.user_data['location'])
         )
 
     except Exception as e:
         # In case there is any error with new location or it is not valid, it
         # will be notified
-        print(e)
-        message = "💣 You need to introduce a valid location."
+        log.error(e)
         context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=message
+            text=INVALID_LOCATION_TEXT
         )
 
 
+def normalize_location(location):
+    '''---------------------------------------------------
+    * Name: normalize_location
+    * Function: Writes a location always in the same way,
+                so that the same place written differently
+                is found in the caches.
+    * Parameters: location: Address (string) or
+                  coordinates (list) of a place.
+    * Return: The address in lowercase and with its words
+              separated by a single space, or the
+              coordinates as a tuple.
+    ---------------------------------------------------'''
+    if isinstance(location, str):
+        return " ".join(location.lower().split())
+    return tuple(location)
+
+
+class OutdatedIgraphError(Exception):
+    '''---------------------------------------------------
+    * Name: OutdatedIgraphError
+    * Function: Error raised by cached_path when the igraph
+                has been updated after taking its version.
+    ---------------------------------------------------'''
+
+
+@lru_cache(maxsize=1024)
+def cached_path(version, location, destination):
+    '''---------------------------------------------------
+    * Name: cached_path
+    * Function: Calculates the shortest path with ispeeds
+                between two locations. The result is saved
+                in a cache until the igraph is updated.
+    * Parameters: version: Version of the igraph used, so
+                  the old paths are not used once the
+                  congestions change.
+                  location, destination: Normalized
+                  locations given by normalize_location.
+    * Return: The shortest path between the locations.
+    * Raises: OutdatedIgraphError if the igraph has been
+              updated after taking the version, so a path
+              of another igraph is never saved with it.
+    ---------------------------------------------------'''
+    with IGRAPH_LOCK:
+        igraph, current_version = IGRAPH, IGRAPH_VERSION
+    if current_version != version:
+        raise OutdatedIgraphError(version)
+    return igo.get_shortest_path_with_ispeeds(igraph, location, destination)
+
+
 def go(update, context):
     '''---------------------------------------------------
     * Name: go
@@ -265,52 +420,103 @@ def go(update, context):
               path with ispeeds.
     ---------------------------------------------------'''
     try:
-        # Print on the terminal a message indicating the user has
+        # Write on the terminal a message indicating the user has
         # started a route with Igo
-        print(update.effective_chat.first_name + " has started a route.")
+        log.info("%s has started a route.", update.effective_chat.first_name)
 
         # Take the destination of the path sent by the user
-        context.user_data['destination'] = update.message.text[4:] + ", Barcelona"
+        context.user_data['destination'] = address_from_args(context.args)
 
         # Send a message saying that the path will be shown
-        message = "Let's go! 🚘 The fastest path to go from "
-        message += str(context.user_data['location'])
-        message += " to "
-        message += str(context.user_data['destination'])
-        message += " is:"
         context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=message
+            text=GO_TEMPLATE.format(
+                location=context.user_data['location'],
+                destination=context.user_data['destination'])
         )
         # Send a message indicating that the procedure is taking place
-        message2 = "...Calculating the fastest route... "
         context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=message2
+            text=CALCULATING_TEXT
         )
 
-        # Get 'intelligent path' between two addresses and plot it into a
-        # PNG image
-        context.user_data['path'] = igo.get_shortest_path_with_ispeeds(IGRAPH, context.user_data['location'], context.user_data['destination'])
-        # Plot the path in the screen
-        igo.plot_path(IGRAPH, context.user_data['path'], SIZE)
+        # Get 'intelligent path' between two addresses (from the cache if it
+        # has already been asked) and plot it into a PNG image. The igraph is
+        # taken once with its version, so the path is drawn on the same
+        # igraph it was calculated on; if it is updated in the meantime, the
+        # path is calculated again on the new one
+        while True:
+            with IGRAPH_LOCK:
+                igraph, version = IGRAPH, IGRAPH_VERSION
+            try:
+                context.user_data['path'] = cached_path(
+                    version,
+                    normalize_location(context.user_data['location']),
+                    normalize_location(context.user_data['destination']))
+                break
+            except OutdatedIgraphError:
+                continue
+        # Plot the path in memory, so the images of different users do not
+        # get mixed in the same file
+        buf = io.BytesIO()
+        igo.plot_path(igraph, context.user_data['path'], SIZE, out=buf)
+        buf.seek(0)
         context.bot.send_photo(
             chat_id=update.effective_chat.id,
-            photo=open('path.png', 'rb'))
-        os.remove('path.png')
+            photo=buf)
 
     except Exception as e:
         # In case there is any error with the destination sent, it will be
         # notified
-        print(e)
-        message = "💣 Your destination is incorrect or your location is "
-        message += "not valid."
+        log.error(e)
         context.bot.send_message(
                 chat_id=update.effective_chat.id,
-                text=message
+                text=INVALID_ROUTE_TEXT
         )
 
 
+def refresh_igraph():
+    '''---------------------------------------------------
+    * Name: refresh_igraph
+    * Function: Updates the congestions and the igraph
+                every UPDATE_INTERVAL seconds. It runs in
+                its own thread, so the users do not have to
+                wait for the update when they ask for a
+                route.
+    * Parameters: -
+    * Return: -
+    ---------------------------------------------------'''
+    global IGRAPH, IGRAPH_VERSION, START_TIME
+    while True:
+        # Wait until the congestions of the igraph are UPDATE_INTERVAL
+        # seconds old. An igraph loaded from the file may already be old
+        wait = UPDATE_INTERVAL - (datetime.datetime.now() - START_TIME).total_seconds()
+        if wait > 0:
+            time.sleep(wait)
+        try:
+            # Downloads the current congestions
+            new_congestions = igo.download_congestions(CONGESTIONS_URL)
+            # Creates a new igraph while the old one is still being used. The
+            # edges of every street found when building it are used again
+            with IGRAPH_LOCK:
+                old_igraph = IGRAPH
+            new_igraph = igo.update_igraph(old_igraph.copy(), highways, new_congestions)
+            # Replaces the old igraph by the new one
+            with IGRAPH_LOCK:
+                IGRAPH = new_igraph
+                IGRAPH_VERSION += 1
+            # Save it so a restart of the bot can use it
+            igo.save_igraph(new_igraph, IGRAPH_FILENAME)
+            # Last update time
+            START_TIME = datetime.datetime.now()
+            # Remove the tiles of the maps that are too old
+            igo.clean_tile_cache()
+        except Exception as e:
+            # If the update fails, the old igraph is kept until the next one
+            log.error(e)
+            time.sleep(UPDATE_INTERVAL)
+
+
 ############################################################
 #                         MAIN
 ############################################################
@@ -318,32 +524,27 @@ def go(update, context):
 # Declares a constant with the access token that reads from token.txt
 TOKEN = open('token.txt').read().strip()
 
-# Creates objects to work with Telegram
-updater = Updater(token=TOKEN, use_context=True)
+# Creates objects to work with Telegram. Several workers let the commands of
+# different users run at the same time
+updater = Updater(token=TOKEN, use_context=True, workers=WORKERS)
 dispatcher = updater.dispatcher
 
-# Indicates when the bot receives one command that function is executed
-dispatcher.add_handler(CommandHandler('start', start))
-dispatcher.add_handler(CommandHandler('help', help))
-dispatcher.add_handler(CommandHandler('author', author))
-dispatcher.add_handler(MessageHandler(Filters.location, location))
-dispatcher.add_handler(CommandHandler('pos', pos))
-dispatcher.add_handler(CommandHandler('where', where))
-dispatcher.add_handler(CommandHandler('go', go))
-
-# Before starting the command go, check if the congestions are updated
-if CommandHandler('go', go):
-    # Takes the time when the command /go is sent
-    current_time = datetime.datetime.now()
-    # Compares if more than 5 minuts have passed since the last update
-    if (current_time - START_TIME > datetime.timedelta(minutes=5)):
-        # Downloads the current congestions
-        congestions = igo.download_congestions(CONGESTIONS_URL)
-        # Creates a new igraph
-        IGRAPH = igo.build_igraph(graph, highways, congestions)
-        # Last update time
-        START_TIME = current_time
+# Indicates when the bot receives one command that function is executed.
+# The commands run asynchronously so a slow one does not block the others
+dispatcher.add_handler(CommandHandler('start', start, run_async=True))
+dispatcher.add_handler(CommandHandler('help', help, run_async=True))
+dispatcher.add_handler(CommandHandler('author', author, run_async=True))
+dispatcher.add_handler(MessageHandler(Filters.location, location, run_async=True))
+dispatcher.add_handler(CommandHandler('pos', pos, run_async=True))
+dispatcher.add_handler(CommandHandler('where', where, run_async=True))
+dispatcher.add_handler(CommandHandler('go', go, run_async=True))
+
+# Update the igraph periodically in the background
+threading.Thread(target=refresh_igraph, daemon=True).start()
 
 # Start the bot
-updater.start_polling()
+updater.start_polling(timeout=POLLING_TIMEOUT)
 updater.idle()
+# Write the messages for the terminal that are still in the queue before
+# exiting
+LOG_LISTENER.stop()
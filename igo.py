@@ -11,23 +11,44 @@ Date: 18_05_2021
 ###########################################################
 # read / write Python data from / to files
 import pickle
-# download files from the web
-import urllib
-# allow us to read / write data in python
-import csv
+# access functionalities dependent on the Operating System
+import os
+import sys
+# gives a short name to each tile of the maps to save it in a file
+import hashlib
+# writes the tiles of the maps in a file before giving it its final name
+import tempfile
+# downloads the tiles of the maps reusing the connections
+import requests
+from requests.adapters import HTTPAdapter
+# downloads and reads csv files into tables
+import pandas as pd
+# asks for the coordinates of two locations at the same time and calculates
+# the paths of the streets in several processes
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+# makes the requests to the geocoding server wait for each other
+import threading
+import time
+# saves the results of functions to avoid repeating calls
+from functools import lru_cache
 # retrieve, model, analyze, and visualize street networks from OpenStreetMap
 import osmnx
 # creation, manipulation, and study of the structure, dynamics, and functions
 # of complex networks
 import networkx as nx
-# creates static, animated, and interactive visualizations
-import matplotlib.pyplot as plt
 # paints maps
 import staticmap
 # connects with Open Street Maps to generate maps with lines and markers
 from staticmap import StaticMap, CircleMarker, Line
 # helps to define tuples
 import collections
+# fast (written in C) graph library used to calculate the shortest paths
+import igraph as ig
+# works with arrays of numbers
+import numpy as np
+# finds quickly the nearest point to a given one
+from sklearn.neighbors import BallTree
 
 import datetime
 
@@ -41,21 +62,58 @@ PLACE = 'Barcelona, Catalonia'
 GRAPH_FILENAME = 'barcelona.graph'
 # Size of the images that will be saved
 SIZE = 800
+# Compression level (0-9) of the PNG images of the maps. They are only used
+# to be sent, so a fast compression is preferred over a small file
+PNG_COMPRESS_LEVEL = 1
+# Size of the buffer (in bytes) used to read and write the graphs (1 MB)
+PICKLE_BUFFER_SIZE = 1 << 20
 # URL from where we can get data from Barcelona's streets
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 # URL from where we can get data from Barcelona's congestions
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+# Color used to represent each level of congestion
+CONGESTION_COLORS = {
+    1: "#68d46c",  # Very fluid: green
+    2: "#68d46c",  # Fluid: green
+    3: "#f87c04",  # Dense: orange
+    4: "#e80404",  # Very dense: red
+    5: "#a01414",  # Congested: darker red
+}
+# Number of processes used to calculate the paths of the streets. Every
+# process ends up with its own copy of the graph, so they are kept few
+PATHS_PROCESSES = min(os.cpu_count() or 1, 4)
+# Graph used by each of these processes. It is given to them once when they
+# start instead of with every path
+PATHS_GRAPH = None
+# Minimum time (in seconds) between two requests to the geocoding server.
+# Nominatim does not allow more than one request per second
+GEOCODE_INTERVAL = 1
+# Lock that makes the requests to the geocoding server start one after the
+# other
+GEOCODE_LOCK = threading.Lock()
+# Moment (time.monotonic) of the last request to the geocoding server
+GEOCODE_LAST_REQUEST = 0.0
+# Directory where the tiles of the maps are saved to not download them again
+TILE_CACHE_DIR = 'tilecache'
+# Seconds a saved tile is used before downloading it again (7 days, the
+# minimum time asked by the tile usage policy of Open Street Maps)
+TILE_MAX_AGE = 7 * 24 * 60 * 60
+# Session shared by all the maps to download the tiles, so the connections to
+# the tile server are reused
+TILE_SESSION = requests.Session()
+TILE_SESSION.mount('http://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
+TILE_SESSION.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=10))
 
 ###########################################################
 #                          TYPES
 ###########################################################
 # Tuple Highway will contain three attributes: way_id (number representing
 # the street), name (of the street), coordinates (where does the street begin
-# and end)
+# and end, as a NumPy array with a row (longitude, latitude) for each point)
 Highway = collections.namedtuple('Highway', 'way_id name coordinates')
 # Tuple Congestion will contain four attributes: way_id (number representing
 # the street), date, usual (usual congestion level), actual (actual congestion
-# level). The congestion levels go from 0 to 6:
+# level). The congestion levels are integers that go from 0 to 6:
 # 0 - No data available
 # 1 - Very fluid
 # 2 - Fluid
@@ -66,10 +124,72 @@ Highway = collections.namedtuple('Highway', 'way_id name coordinates')
 Congestion = collections.namedtuple('Congestion', 'way_id date usual actual')
 
 
+class CachedStaticMap(StaticMap):
+    '''----------------------------------------------------
+    * Name: CachedStaticMap
+    * Function: StaticMap that saves the tiles it downloads
+    *           in TILE_CACHE_DIR and reads them from there
+    *           the next time any map needs them, instead
+    *           of asking the tile server again. The tiles
+    *           older than TILE_MAX_AGE are downloaded
+    *           again.
+    ----------------------------------------------------'''
+
+    def get(self, url, **kwargs):
+        '''------------------------------------------------
+        * Name: get
+        * Function: Gets a tile from the cache or downloads
+        *           it with TILE_SESSION and saves it.
+        * Parameters: url: URL of the tile.
+        *             kwargs: Arguments of the request.
+        * Return: The status code and the content of the
+        *         tile.
+        ------------------------------------------------'''
+        file_name = os.path.join(TILE_CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest())
+        try:
+            if time.time() - os.path.getmtime(file_name) < TILE_MAX_AGE:
+                with open(file_name, 'rb') as file:
+                    return 200, file.read()
+        except OSError:
+            # The tile is not saved (or has just been removed)
+            pass
+        response = TILE_SESSION.get(url, **kwargs)
+        if response.status_code == 200:
+            os.makedirs(TILE_CACHE_DIR, exist_ok=True)
+            # Write the tile in a temporary file and then rename it, so
+            # another map never reads a tile that is half written
+            with tempfile.NamedTemporaryFile(dir=TILE_CACHE_DIR, delete=False) as file:
+                file.write(response.content)
+            os.replace(file.name, file_name)
+        return response.status_code, response.content
+
+
 ###########################################################
 #                        FUNCTIONS
 ###########################################################
 
+def clean_tile_cache():
+    '''----------------------------------------------------
+    * Name: clean_tile_cache
+    * Function: Removes from TILE_CACHE_DIR the tiles older
+    *           than TILE_MAX_AGE, so the tiles that are no
+    *           longer asked do not fill the disk.
+    * Parameters: -
+    * Return: -
+    ----------------------------------------------------'''
+    if not os.path.isdir(TILE_CACHE_DIR):
+        return
+    limit = time.time() - TILE_MAX_AGE
+    with os.scandir(TILE_CACHE_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_file() and entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            except OSError:
+                # Another map has just replaced or removed it
+                pass
+
+
 def exists_graph(file_name):
     '''----------------------------------------------------
     * Name: exists_graph
@@ -79,13 +199,7 @@ def exists_graph(file_name):
     *             to check if it exists or not.
     * Return: True if the file exists; False otherwise.
     ----------------------------------------------------'''
-    try:
-        f = open(file_name)
-    except FileNotFoundError:
-        return False
-
-    f.close()
-    return True
+    return os.path.isfile(file_name)
 
 
 def download_graph(place):
@@ -119,8 +233,8 @@ def save_graph(graph, file_name):
     *                        want to save the graph.
     * Return: -
     ----------------------------------------------------'''
-    with open(file_name, 'wb') as file:
-        pickle.dump(graph, file)
+    with open(file_name, 'wb', buffering=PICKLE_BUFFER_SIZE) as file:
+        pickle.dump(graph, file, protocol=pickle.HIGHEST_PROTOCOL)
 
 
 def load_graph(file_name):
@@ -131,7 +245,7 @@ def load_graph(file_name):
     *             we want to load the graph.
     * Return: The graph from the file given.
     ----------------------------------------------------'''
-    with open(file_name, 'rb') as file:
+    with open(file_name, 'rb', buffering=PICKLE_BUFFER_SIZE) as file:
         graph = pickle.load(file)
     return graph
 
@@ -146,6 +260,23 @@ def plot_graph(graph):
     osmnx.plot.plot_graph(graph)
 
 
+def parse_coordinates(coordinates):
+    '''----------------------------------------------------
+    * Name: parse_coordinates
+    * Function: Converts the coordinates of a street,
+    *           written as "lon1,lat1,lon2,lat2,...", into
+    *           numbers all at once thanks to NumPy.
+    * Parameters: coordinates: String with the
+    *             coordinates separated by commas.
+    * Return: A NumPy array with a row (longitude,
+    *         latitude) for each point.
+    ----------------------------------------------------'''
+    # A wrong value raises an error instead of cutting the coordinates
+    values = np.array(coordinates.split(','), dtype=np.float64)
+    # If there is a longitude without its latitude, ignore it
+    return values[:len(values) // 2 * 2].reshape(-1, 2)
+
+
 def download_highways(highways_url):
     '''----------------------------------------------------
     * Name: download_highways
@@ -154,23 +285,33 @@ def download_highways(highways_url):
     *           it into a list of tuple Highway.
     * Parameters: highways_url: URL from where the data
     *             must be downloaded.
-    * Return: A list of data (tuple Congestion) from a
-    *         place congestions.
+    * Return: A list of data (tuple Highway) from a
+    *         place streets.
     ----------------------------------------------------'''
-    highways = []  # Will save the data of the csv lines
-    with urllib.request.urlopen(highways_url) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
-        next(reader)  # Ignore first line with description
-        # Convert into Highway tuple each line and return a
-        # list of Highway tuple
-        for u_line in reader:
-            way_id, name, coordinates = u_line
-            highway = Highway(way_id, name, coordinates)
-            highways.append(highway)
+    # Read all the csv at once, ignoring the first line with description
+    data = pd.read_csv(highways_url, sep=',', quotechar='"', skiprows=1,
+                       names=['way_id', 'name', 'coordinates'], dtype=str,
+                       keep_default_na=False)
+    # Convert into Highway tuple each line and return a
+    # list of Highway tuple
+    highways = [Highway(way_id, name, parse_coordinates(coordinates))
+                for way_id, name, coordinates in zip(data['way_id'], data['name'], data['coordinates'])]
     return highways
 
 
+def marker_key(point):
+    '''----------------------------------------------------
+    * Name: marker_key
+    * Function: Rounds the coordinates of a point, so two
+    *           circles on the same place of the map can be
+    *           detected.
+    * Parameters: point: Coordinates (longitude, latitude)
+    *             of the point.
+    * Return: The coordinates rounded to 6 decimals.
+    ----------------------------------------------------'''
+    return (round(point[0], 6), round(point[1], 6))
+
+
 def plot_highways(highways, file_name, size):
     '''----------------------------------------------------
     * Name: plot_highways
@@ -185,26 +326,27 @@ def plot_highways(highways, file_name, size):
     * Return: An image saved of a map of a place streets.
     ----------------------------------------------------'''
     # Create a map of dimensions (size x size)
-    highways_map = StaticMap(size, size)
+    highways_map = CachedStaticMap(size, size)
+    # Points that already have a circle, as many streets meet in the same one
+    seen = set()
     for x in range(0, len(highways)):
-        # Convert the coordinates string into a list
-        coordinates = highways[x].coordinates.split(',')
-        # Will save the coordinates in order to make a line between them
-        line_coord = []
-        for i in range(0, len(coordinates) - 1, 2):
-            # Every two coordinates we read the longitude and latitude,
-            # respectively, of a point
-            longitude = float(coordinates[i])
-            latitude = float(coordinates[i+1])
-            # Put a circle on the point
-            marker = CircleMarker((longitude, latitude), 'cyan', 3)
-            highways_map.add_marker(marker)
-            line_coord.append((longitude, latitude))
-        # Add a line between the points marked on the map
+        # Every row has the longitude and latitude, respectively, of a point
+        line_coord = [tuple(point) for point in highways[x].coordinates.tolist()]
+        if not line_coord:
+            continue
+        # Put a circle only on the beginning and the end of the street, the
+        # line covers the points in the middle
+        for point in (line_coord[0], line_coord[-1]):
+            key = marker_key(point)
+            if key in seen:
+                continue
+            seen.add(key)
+            highways_map.add_marker(CircleMarker(point, 'cyan', 3))
+        # Add a line between the points of the street
         highways_map.add_line(Line(line_coord, 'cyan', 3))
     # Construct and save the map with the name indicated by the user
     image = highways_map.render()
-    image.save(file_name)
+    image.save(file_name, optimize=False, compress_level=PNG_COMPRESS_LEVEL)
 
 
 def download_congestions(congestions_url):
@@ -218,16 +360,18 @@ def download_congestions(congestions_url):
     * Return: A list of data (tuple Congestion) from a
     *         place congestions.
     ----------------------------------------------------'''
-    congestions = []  # Will save the data of the csv lines
-    with urllib.request.urlopen(congestions_url) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter='#')
-        for u_line in reader:
-            # Convert into Congestion tuple each line and return a
-            # list of Congestion tuple
-            way_id, date, usual, actual = u_line
-            congestion = Congestion(way_id, date, usual, actual)
-            congestions.append(congestion)
+    # Read all the csv at once
+    data = pd.read_csv(congestions_url, sep='#', header=None,
+                       names=['way_id', 'date', 'usual', 'actual'], dtype=str,
+                       keep_default_na=False)
+    # The congestion levels are saved as integers to compare them quickly.
+    # An empty or wrong level is taken as 0 (no data available)
+    usual = pd.to_numeric(data['usual'], errors='coerce').fillna(0).astype(np.int8)
+    actual = pd.to_numeric(data['actual'], errors='coerce').fillna(0).astype(np.int8)
+    # Convert into Congestion tuple each line and return a
+    # list of Congestion tuple
+    congestions = [Congestion(way_id, date, int(usual_level), int(actual_level))
+                   for way_id, date, usual_level, actual_level in zip(data['way_id'], data['date'], usual, actual)]
     return congestions
 
 
@@ -242,18 +386,8 @@ def congestion_color(congestion):
     * Return: An string representing a color related to
     *         the congestion given.
     ----------------------------------------------------'''
-    if congestion == "1":
-        return "#68d46c"  # If very fluid return green
-    elif congestion == "2":
-        return "#68d46c"  # If fluid return green
-    elif congestion == "3":
-        return "#f87c04"  # If dense return orange
-    elif congestion == "4":
-        return "#e80404"  # If very dense return red
-    elif congestion == "5":
-        return "#a01414"  # If congested return darker red
-    else:
-        return "black"  # If cut return black
+    # If cut (or anything else) return black
+    return CONGESTION_COLORS.get(congestion, "black")
 
 
 def get_congestion(congestion):
@@ -273,57 +407,377 @@ def get_congestion(congestion):
     ----------------------------------------------------'''
     # If we have no data we adjudicate the value of fluid to the
     # congestion level
-    if congestion.usual == "0" and congestion.actual == "0":
-        return "2"
+    if congestion.usual == 0 and congestion.actual == 0:
+        return 2
     # If we have actual data and it is different to the usual one,
     # return the actual level
-    elif congestion.usual != congestion.actual and congestion.actual != "0":
+    elif congestion.usual != congestion.actual and congestion.actual != 0:
         return congestion.actual
     # Else return the usual level
     else:
         return congestion.usual
 
 
-def plot_congestions(highways, congestions, file_name, size):
+def congestions_table(congestions):
+    '''----------------------------------------------------
+    * Name: congestions_table
+    * Function: Builds a table with the final level of
+    *           congestion of every street, so it is only
+    *           calculated once. The usual and actual
+    *           levels are kept in NumPy arrays of small
+    *           integers and the final ones are decided for
+    *           all the streets at once, as get_congestion
+    *           does for one of them. A dictionary relates
+    *           every way_id to its position in the arrays.
+    * Parameters: congestions: List of data from the
+    *             congestions of the place.
+    * Return: The dictionary way_id -> position and the
+    *         array of congestion levels.
+    ----------------------------------------------------'''
+    # If a way_id is repeated, its last congestion is the one kept
+    way_index = {congestion.way_id: i for i, congestion in enumerate(congestions)}
+    usual = np.array([congestion.usual for congestion in congestions], dtype=np.int8)
+    actual = np.array([congestion.actual for congestion in congestions], dtype=np.int8)
+    # If we have no data we adjudicate the value of fluid (2); if we have
+    # actual data and it is different to the usual one, take the actual
+    # level; else take the usual level
+    levels = np.where((usual == 0) & (actual == 0), 2,
+                      np.where((usual != actual) & (actual != 0), actual, usual)).astype(np.int8)
+    return way_index, levels
+
+
+def group_highways(highways):
+    '''----------------------------------------------------
+    * Name: group_highways
+    * Function: Groups the streets of a place by their
+    *           way_id, so the streets of a congestion can
+    *           be found without looking at all of them.
+    * Parameters: highways: List of data from a place
+    *             streets.
+    * Return: A dictionary that relates every way_id with
+    *         the list of its Highway tuples.
+    ----------------------------------------------------'''
+    highways_by_id = collections.defaultdict(list)
+    for highway in highways:
+        highways_by_id[highway.way_id].append(highway)
+    return highways_by_id
+
+
+def plot_congestions(highways, congestions, file_name, size, highways_by_id=None):
     '''----------------------------------------------------
     * Name: plot_congestions
     * Function: Saves a map of a place congestions thanks
     *           to StaticMap. The map can be ploted after
     *           using the function.
-    * Parameters: congestions: List of data from a place
+    * Parameters: highways: List of data from a place
+    *             streets.
+    *             congestions: List of data from a place
     *             congestions.
     *             file_name: Name of the file where the
     *             user wants to save the map.
     *             size: Size of the map.
+    *             highways_by_id: Streets grouped by
+    *             group_highways. If it is not given, it
+    *             is calculated from highways.
     * Return: -
     ----------------------------------------------------'''
+    if highways_by_id is None:
+        highways_by_id = group_highways(highways)
     # Create a map of dimensions (size x size)
-    congestions_map = StaticMap(size, size)
-    for x in range(0, len(highways)):
-        # Convert the coordinates string into a list
-        coordinates = highways[x].coordinates.split(',')
-        for y in range(0, len(congestions)):
-            # Will save the coordinates in order to make a line between them
-            line_coord = []
-            # Relate same streets by the way_id
-            if highways[x].way_id == congestions[y].way_id:
-                for i in range(0, len(coordinates) - 1, 2):
-                    # Every two coordinates we read the longitude and latitude,
-                    # respectively, of a point
-                    longitude = float(coordinates[i])
-                    latitude = float(coordinates[i+1])
-                    # Decide which level of congestion will be added
-                    congestion_level = get_congestion(congestions[y])
-                    # Put a circle on the map corresponding to the point and of
-                    # the color given by the congestion_color function
-                    marker = CircleMarker((longitude, latitude), congestion_color(congestion_level), 3)
-                    congestions_map.add_marker(marker)
-                    line_coord.append((longitude, latitude))
-                # Add a line between all points added on the map
-                congestions_map.add_line(Line(line_coord, congestion_color(congestion_level), 3))
+    congestions_map = CachedStaticMap(size, size)
+    # Table with the level of congestion of each street, calculated once
+    way_index, levels = congestions_table(congestions)
+    # Points that already have a circle, as many streets meet in the same one
+    seen = set()
+    for way_id, position in way_index.items():
+        # Decide which level of congestion will be added and its color
+        congestion_level = int(levels[position])
+        color = congestion_color(congestion_level)
+        # Relate same streets by the way_id
+        for highway in highways_by_id.get(way_id, ()):
+            # Every row has the longitude and latitude, respectively, of a
+            # point
+            line_coord = [tuple(point) for point in highway.coordinates.tolist()]
+            if not line_coord:
+                continue
+            # Put a circle only on the beginning and the end of the street,
+            # the line covers the points in the middle
+            for point in (line_coord[0], line_coord[-1]):
+                key = marker_key(point)
+                if key in seen:
+                    continue
+                seen.add(key)
+                congestions_map.add_marker(CircleMarker(point, color, 3))
+            # Add a line between all points of the street on the map
+            congestions_map.add_line(Line(line_coord, color, 3))
     # Construct and save the map with the name given by the user
     image = congestions_map.render()
-    image.save(file_name)
+    image.save(file_name, optimize=False, compress_level=PNG_COMPRESS_LEVEL)
+
+
+def nodes_tree(graph):
+    '''----------------------------------------------------
+    * Name: nodes_tree
+    * Function: Gives a BallTree with the coordinates of
+    *           the nodes of the graph, so the nearest
+    *           node to a point can be found without
+    *           looking at all the nodes. The tree is built
+    *           only the first time and saved in the
+    *           attributes of the graph.
+    * Parameters: graph: Graph of a place.
+    * Return: The tree and the list of nodes in the same
+    *         order as the points of the tree.
+    ----------------------------------------------------'''
+    if 'nodes_tree' not in graph.graph:
+        nodes = []
+        coordinates = []
+        for node, data in graph.nodes(data=True):
+            nodes.append(node)
+            coordinates.append((data['y'], data['x']))
+        # The haversine distance needs the latitude and longitude in radians
+        graph.graph['nodes_tree'] = BallTree(np.radians(coordinates), metric='haversine')
+        graph.graph['tree_nodes'] = nodes
+    return graph.graph['nodes_tree'], graph.graph['tree_nodes']
+
+
+def nearest_nodes(graph, longitudes, latitudes):
+    '''----------------------------------------------------
+    * Name: nearest_nodes
+    * Function: Finds the nodes of the graph nearest to a
+    *           list of points with the tree of the nodes.
+    * Parameters: graph: Graph of a place.
+    *             longitudes, latitudes: Lists with the
+    *             coordinates of the points.
+    * Return: A list with the nearest node to each point.
+    ----------------------------------------------------'''
+    tree, nodes = nodes_tree(graph)
+    points = np.radians(np.column_stack([latitudes, longitudes]))
+    indices = tree.query(points, k=1, return_distance=False)[:, 0]
+    return [nodes[i] for i in indices]
+
+
+def nearest_node(graph, longitude, latitude):
+    '''----------------------------------------------------
+    * Name: nearest_node
+    * Function: Finds the node of the graph nearest to a
+    *           point with the tree of the nodes.
+    * Parameters: graph: Graph of a place.
+    *             longitude, latitude: Coordinates of the
+    *             point.
+    * Return: The nearest node to the point.
+    ----------------------------------------------------'''
+    return nearest_nodes(graph, [longitude], [latitude])[0]
+
+
+def highways_edges(graph, highways):
+    '''----------------------------------------------------
+    * Name: highways_edges
+    * Function: Finds the edges of the graph that every
+    *           street goes through. This only depends on
+    *           the graph and the streets, so it is done
+    *           once and used every time the congestions
+    *           change.
+    * Parameters: graph: Graph of a place.
+    *             highways: List of data from the streets
+    *             of the place.
+    * Return: A dictionary that relates every way_id with
+    *         the list of edges (u, v, key) of its street.
+    ----------------------------------------------------'''
+    # Start and end points of every segment of street and its way_id
+    starts = []
+    ends = []
+    segment_way_ids = []
+    for x in range(0, len(highways)):
+        coordinates = highways[x].coordinates
+        # Every two points we define a segment of street
+        segment_starts = coordinates[:-1:2]
+        starts.append(segment_starts)
+        ends.append(coordinates[1::2])
+        segment_way_ids.extend([highways[x].way_id] * len(segment_starts))
+    edges = {}
+    if segment_way_ids:
+        # Find the nodes from the osmnx graph nearer to the ones defined by
+        # the data in highway, all of them at once
+        starts = np.concatenate(starts)
+        ends = np.concatenate(ends)
+        nodes_start = nearest_nodes(graph, starts[:, 0], starts[:, 1])
+        nodes_end = nearest_nodes(graph, ends[:, 0], ends[:, 1])
+        # Find the shortest path between the nodes of every segment. The
+        # paths do not depend on each other, so they are calculated in
+        # several processes if the graph can be copied into them safely
+        segments = list(zip(nodes_start, nodes_end))
+        if PATHS_PROCESSES > 1 and can_fork():
+            with ProcessPoolExecutor(PATHS_PROCESSES,
+                                     mp_context=multiprocessing.get_context('fork'),
+                                     initializer=init_paths_process,
+                                     initargs=(graph,)) as executor:
+                paths = list(executor.map(segment_path, segments, chunksize=64))
+        else:
+            init_paths_process(graph)
+            paths = [segment_path(segment) for segment in segments]
+            init_paths_process(None)
+        # The adjacency of the graph is read directly, without the views
+        # that graph[u] creates every time
+        adj = graph._adj
+        for way_id, shortest_rute in zip(segment_way_ids, paths):
+            way_edges = edges.setdefault(way_id, [])
+            # If no shortest_path has been found, pass.
+            # A level 2 of congestion will be added later.
+            if shortest_rute is None:
+                continue
+            # Walk every pair of consecutive nodes of the path and keep
+            # all the edges between them
+            for u, v in zip(shortest_rute, shortest_rute[1:]):
+                for j in adj[u][v]:
+                    way_edges.append((u, v, j))
+    return edges
+
+
+def can_fork():
+    '''----------------------------------------------------
+    * Name: can_fork
+    * Function: Checks if the processes that calculate the
+    *           paths can be created with fork. It is only
+    *           safe on Linux and when no other thread is
+    *           running, as a forked process could get a
+    *           lock held by one of them forever. Spawned
+    *           processes are not used because they would
+    *           import the bot (and build the graph) again.
+    * Parameters: -
+    * Return: True if fork can be used; False otherwise.
+    ----------------------------------------------------'''
+    return sys.platform.startswith('linux') and threading.active_count() == 1
+
+
+def init_paths_process(graph):
+    '''----------------------------------------------------
+    * Name: init_paths_process
+    * Function: Saves the graph that a process will use to
+    *           calculate the paths of the streets.
+    * Parameters: graph: Graph of a place.
+    * Return: -
+    ----------------------------------------------------'''
+    global PATHS_GRAPH
+    PATHS_GRAPH = graph
+
+
+def segment_path(segment):
+    '''----------------------------------------------------
+    * Name: segment_path
+    * Function: Finds the shortest path (by length) between
+    *           the two nodes of a segment of street in
+    *           the graph given to init_paths_process.
+    * Parameters: segment: Pair of nodes (start, end).
+    * Return: The list of nodes of the path, or None if
+    *         there is no path between them.
+    ----------------------------------------------------'''
+    node_start, node_end = segment
+    try:
+        return osmnx.distance.shortest_path(PATHS_GRAPH, node_start, node_end, weight='length')
+    except Exception:
+        return None
+
+
+def add_congestions(igraph, congestions):
+    '''----------------------------------------------------
+    * Name: add_congestions
+    * Function: Adds the congestion attribute to every
+    *           edge of the igraph, using the edges of
+    *           each street found by highways_edges. The
+    *           edges without data get level 2 (fluid).
+    * Parameters: igraph: Graph of a place with the edges
+    *             of each street in its attributes.
+    *             congestions: List of data from the
+    *             congestions of the place.
+    * Return: -
+    ----------------------------------------------------'''
+    # Remove the congestions of a previous update: adjudicate level 2 (the
+    # standard one) to all the edges
+    for (u, v, way) in igraph.edges(data=True):
+        way['congestion'] = 2
+    # Table with the level of congestion of each street, calculated once
+    way_index, levels = congestions_table(congestions)
+    # The adjacency of the graph is read directly, without the views that
+    # igraph[u] creates every time
+    adj = igraph._adj
+    for way_id, edges in igraph.graph['highways_edges'].items():
+        # Relate same streets by the way_id
+        position = way_index.get(way_id)
+        if position is None:
+            continue
+        # Level of congestion that will be added
+        congestion_level = int(levels[position])
+        for (u, v, j) in edges:
+            adj[u][v][j]['congestion'] = congestion_level
+
+
+def edge_speeds(igraph):
+    '''----------------------------------------------------
+    * Name: edge_speeds
+    * Function: Gives the length and the maxspeeds of every
+    *           edge of the igraph as NumPy arrays, in the
+    *           order of igraph.edges. They do not change
+    *           when the congestions are updated, so they
+    *           are read only the first time and saved in
+    *           the attributes of the igraph.
+    * Parameters: igraph: Graph of a place.
+    * Return: Three arrays: the lengths, the speeds used
+    *         with low congestion and the speeds used
+    *         with considerable congestion.
+    ----------------------------------------------------'''
+    if 'edge_speeds' not in igraph.graph:
+        lengths = []
+        fast_speeds = []
+        slow_speeds = []
+        for (u, v, way) in igraph.edges(data=True):
+            # If the edge does not have the attribute maxspeed,
+            # adjudicate 30 (the maximum pemitted in cities)
+            if 'maxspeed' not in way:
+                way['maxspeed'] = "30"
+            # If there are more than one maxspeed for the same street, the
+            # highest one is taken if the congestion is low and the lowest
+            # one if the congestion level is considerable
+            if type(way['maxspeed']) == list:
+                fast_speeds.append(way['maxspeed'][0])
+                slow_speeds.append(way['maxspeed'][1])
+            else:
+                fast_speeds.append(way['maxspeed'])
+                slow_speeds.append(way['maxspeed'])
+            lengths.append(way['length'])
+        igraph.graph['edge_speeds'] = (np.asarray(lengths, dtype=np.float32),
+                                       np.asarray(fast_speeds, dtype=np.float32),
+                                       np.asarray(slow_speeds, dtype=np.float32))
+    return igraph.graph['edge_speeds']
+
+
+def add_itimes(igraph):
+    '''----------------------------------------------------
+    * Name: add_itimes
+    * Function: Adds the itime attribute to every edge of
+    *           the igraph from its length, maxspeed and
+    *           congestion.
+    * Parameters: igraph: Graph of a place with the
+    *             congestion attribute.
+    * Return: -
+    ----------------------------------------------------'''
+    lengths, fast_speeds, slow_speeds = edge_speeds(igraph)
+    # Travese the entire graph keeping the congestion of each edge. If the
+    # edge does not have the attribute congestion, adjudicate level 2 (the
+    # standard one)
+    ways = [way for (u, v, way) in igraph.edges(data=True)]
+    congestion_levels = np.asarray([way.setdefault('congestion', 2) for way in ways], dtype=np.int8)
+    # Take the speed depending on the congestion level of every edge
+    speeds = np.where(congestion_levels <= 2, fast_speeds, slow_speeds)
+    # The itime takes into consediration the time it takes going
+    # through the street depending only on its length and maxspeed.
+    # Then it is multiplied by the congestion level. The higher the
+    # congestion level is, higher will be the itime attribute.
+    # It is calculated for all the edges at once with NumPy, using small
+    # number types (float32 and int8) so the arrays take less memory
+    itimes = (lengths * congestion_levels / speeds).astype(np.float32)
+    # Add attribute to the graph
+    for way, itime in zip(ways, itimes.tolist()):
+        way['itime'] = itime
 
 
 def build_igraph(graph, highways, congestions):
@@ -345,62 +799,138 @@ def build_igraph(graph, highways, congestions):
     * Return: The graph with the attributes congestion
     *         and itime.
     ----------------------------------------------------'''
-    for x in range(0, len(highways)):
-        # Convert the coordinates string into a list
-        coordinates = highways[x].coordinates.split(',')
-        for y in range(0, len(congestions)):
-            # Relate same streets by the way_id
-            if highways[x].way_id == congestions[y].way_id:
-                # Decide which level of congestion will be added
-                congestion_level = get_congestion(congestions[y])
-                for i in range(0, len(coordinates) - 3, 4):
-                    # Every four coordinates we define a segment of street
-                    # (two pairs of points)
-                    # Find the nodes from the osmnx graph nearer to the ones
-                    # defined by the data in highway
-                    node_start = osmnx.distance.nearest_nodes(graph, float(coordinates[i+1]), float(coordinates[i]))
-                    node_end = osmnx.distance.nearest_nodes(graph, float(coordinates[i+3]), float(coordinates[i+2]))
-                    try:
-                        # Find the shortest path between the nodes if possible
-                        # and add to the edge the congestion attribute
-                        shortest_rute = osmnx.distance.shortest_path(graph, node_start, node_end, weight='length')
-                        for x in range(0, len(shortest_rute)-1, 2):
-                            for j in graph[x][x+1]:
-                                graph[shortest_rute[x]][shortest_rute[x+1]][j]['congestion'] = congestion_level
-                    except:
-                        # If no shortest_path has been found, pass.
-                        # A level 2 of congestion will be added later.
-                        pass
-    # Travese the entire graph
-    for (u, v, length) in graph.edges.data('length'):
-        for i in graph[u][v]:
-            way = graph[u][v][i]
-            # If the edge does not have the attribute congestion,
-            # adjudicate level 2 (the standard one)
-            if 'congestion' not in way:
-                way['congestion'] = "2"
-            # If the edge does not have the attribute maxspeed,
-            # adjudicate 30 (the maximum pemitted in cities)
-            if 'maxspeed' not in way:
-                way['maxspeed'] = "30"
-            # If there are more than one maxspeed for the same street
-            if type(way['maxspeed']) == list:
-                # Take the highest one if the congestion is low
-                if way['congestion'] <= "2":
-                    speed = way['maxspeed'][0]
-                # Take the lowest one if the congestion level is considerable
-                else:
-                    speed = way['maxspeed'][1]
-            else:
-                speed = way['maxspeed']
-            # The itime takes into consediration the time it takes going
-            # through the street depending only on its length and maxspeed.
-            # Then it is multiplied by the congestion level. The higher the
-            # congestion level is, higher will be the itime attribute
-            itime = float(length) * float(way['congestion']) / float(speed)
-            # Add attribute to the graph
-            way['itime'] = itime
-    return graph
+    # Find the edges of every street, kept in the attributes of the graph
+    # for the next updates
+    graph.graph['highways_edges'] = highways_edges(graph, highways)
+    # The lengths and speeds of the edges are read again from this graph
+    graph.graph.pop('edge_speeds', None)
+    return update_igraph(graph, highways, congestions)
+
+
+def update_igraph(igraph, highways, congestions):
+    '''----------------------------------------------------
+    * Name: update_igraph
+    * Function: Changes the congestion and itime
+    *           attributes of an igraph to new congestions.
+    *           The edges of every street found when the
+    *           igraph was built are used again, so only
+    *           the attributes are calculated.
+    * Parameters: igraph: Graph of a place built with
+    *             build_igraph.
+    *             highways: List of data from the streets
+    *             of the place, only used if the igraph
+    *             does not have the edges of each street.
+    *             congestion: List of data from the
+    *             congestions of the place.
+    * Return: The graph with the new attributes congestion
+    *         and itime.
+    ----------------------------------------------------'''
+    if 'highways_edges' not in igraph.graph:
+        igraph.graph['highways_edges'] = highways_edges(igraph, highways)
+    add_congestions(igraph, congestions)
+    add_itimes(igraph)
+    # Add a copy of the graph ready to calculate the shortest paths quickly
+    add_route_graph(igraph)
+    # Make sure the tree to find the nearest nodes to the users' locations
+    # is ready before the first route is asked
+    nodes_tree(igraph)
+    # Add the coordinates of the nodes, used every time a path is plotted
+    if 'node_coords' not in igraph.graph:
+        add_nodes_coordinates(igraph)
+    return igraph
+
+
+def add_route_graph(igraph):
+    '''----------------------------------------------------
+    * Name: add_route_graph
+    * Function: Builds a python-igraph graph with the same
+    *           nodes and edges of the igraph and the itime
+    *           as the weight of the edges. Dijkstra is
+    *           much faster on it than on the NetworkX
+    *           graph. It is saved in the attributes of
+    *           the igraph together with the relation
+    *           between the nodes of both graphs.
+    * Parameters: igraph: Graph of a place with congestion
+    *             and itime attributes.
+    * Precondition: The graph should contain the itime
+    *               attribute.
+    * Return: -
+    ----------------------------------------------------'''
+    # The vertices of the python-igraph graph are numbered from 0, so we
+    # relate every node of the igraph with its number
+    nodes = list(igraph.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = []
+    weights = []
+    for (u, v, itime) in igraph.edges.data('itime'):
+        edges.append((index[u], index[v]))
+        weights.append(itime)
+    route_graph = ig.Graph(n=len(nodes), edges=edges, directed=True)
+    route_graph.es['weight'] = weights
+    igraph.graph['route_graph'] = route_graph
+    igraph.graph['route_nodes'] = nodes
+    igraph.graph['route_index'] = index
+
+
+def add_nodes_coordinates(igraph):
+    '''----------------------------------------------------
+    * Name: add_nodes_coordinates
+    * Function: Saves in the attributes of the igraph a
+    *           dictionary with the coordinates
+    *           (longitude, latitude) of every node, so
+    *           plot_path does not need to look for them
+    *           in the graph every time.
+    * Parameters: igraph: Graph of a place.
+    * Return: -
+    ----------------------------------------------------'''
+    igraph.graph['node_coords'] = {node: (data['x'], data['y']) for node, data in igraph.nodes(data=True)}
+
+
+@lru_cache(maxsize=1024)
+def geocode(address):
+    '''----------------------------------------------------
+    * Name: geocode
+    * Function: Gets the coordinates of an address thanks
+    *           to Osmnx. The result is saved in a cache so
+    *           the same address is not asked twice to the
+    *           geocoding server. The requests to the
+    *           server start at least GEOCODE_INTERVAL
+    *           seconds apart, even when several threads ask
+    *           at the same moment.
+    * Parameters: address: Address we want to locate.
+    * Return: The coordinates (lat, lon) of the address.
+    ----------------------------------------------------'''
+    global GEOCODE_LAST_REQUEST
+    # Only the wait for the next free moment is done with the lock, so a
+    # slow answer of the server does not block the other requests
+    with GEOCODE_LOCK:
+        wait = GEOCODE_LAST_REQUEST + GEOCODE_INTERVAL - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        GEOCODE_LAST_REQUEST = time.monotonic()
+    return osmnx.geocode(address)
+
+
+def locate(location):
+    '''----------------------------------------------------
+    * Name: locate
+    * Function: Gets the coordinates of a location thanks
+    *           to the geocode of Osmnx.
+    * Parameters: location: Address (string) or
+    *             coordinates (list or tuple of lat, lon)
+    *             of the location.
+    * Return: The coordinates (lat, lon) of the location.
+    ----------------------------------------------------'''
+    # If the location is given as a word, will force the coordinates
+    # written in it look like a list. Ex: if we have (41.2, 2.18), we
+    # want [41.2, 2.18]
+    if isinstance(location, str):
+        location = location.replace("(", "[")
+        location = location.replace(")", "]")
+        return geocode(location)
+    # If the location is given as a list or tuple, it already has the
+    # coordinates (lat, lon) and there is no need to ask for them
+    return tuple(location)
 
 
 def get_shortest_path_with_ispeeds(igraph, actual_location, dest_location):
@@ -420,33 +950,34 @@ def get_shortest_path_with_ispeeds(igraph, actual_location, dest_location):
     * Return: The shortest path between actual_location
     *         and dest_location.
     ----------------------------------------------------'''
-    # If the locations are not given as a word or a list, will force
-    # it looks like them. Ex: if we have (41.2, 2.18), we want [41.2, 2.18]
-    # Get the geocode of the locations
-    if type(actual_location) == str:
-        actual_location = actual_location.replace("(", "[")
-        actual_location = actual_location.replace(")", "]")
-        actual_loc = osmnx.geocode(actual_location)
-    else:
-        actual_location_str = str(actual_location)
-        actual_loc = osmnx.geocode(actual_location_str)
-
-    if type(dest_location) == str:
-        dest_location = dest_location.replace("(", "[")
-        dest_location = dest_location.replace(")", "]")
-        dest_loc = osmnx.geocode(dest_location)
-    else:
-        dest_location_str = str(dest_location)
-        dest_loc = osmnx.geocode(dest_location_str)
+    # Get the geocode of both locations at the same time. The requests to
+    # the geocoding server start one second apart (see geocode), but the
+    # answers are waited for at the same time
+    with ThreadPoolExecutor(2) as executor:
+        actual_future = executor.submit(locate, actual_location)
+        dest_future = executor.submit(locate, dest_location)
+        actual_loc = actual_future.result()
+        dest_loc = dest_future.result()
     # Get the nearest node from the one given by the geocode on the igraph
-    actual_node = osmnx.distance.nearest_nodes(igraph, actual_loc[1], actual_loc[0])
-    dest_node = osmnx.distance.nearest_nodes(igraph, dest_loc[1], dest_loc[0])
+    actual_node = nearest_node(igraph, actual_loc[1], actual_loc[0])
+    dest_node = nearest_node(igraph, dest_loc[1], dest_loc[0])
     # Get the shortest path between the nodes depending on the itime attribute
-    path = osmnx.distance.shortest_path(igraph, actual_node, dest_node, weight='itime')
+    route_graph = igraph.graph.get('route_graph')
+    if route_graph is None:
+        # The igraph was built without the python-igraph graph
+        return osmnx.distance.shortest_path(igraph, actual_node, dest_node, weight='itime')
+    index = igraph.graph['route_index']
+    vertices = route_graph.get_shortest_paths(index[actual_node], index[dest_node], weights='weight', output='vpath')[0]
+    # If there is no path between the nodes, return None as osmnx does
+    if not vertices:
+        return None
+    # Translate the vertices of the python-igraph graph into igraph nodes
+    nodes = igraph.graph['route_nodes']
+    path = [nodes[i] for i in vertices]
     return path
 
 
-def plot_path(igraph, ipath, size):
+def plot_path(igraph, ipath, size, out='path.png'):
     '''----------------------------------------------------
     * Name: plot_path
     * Function: Saves and image of a map of the place
@@ -460,12 +991,22 @@ def plot_path(igraph, ipath, size):
     *             and itime attributes.
     *             ipath: Shortest path between two points.
     *             size: Size of the image of the map.
+    *             out: Name of the file or file object
+    *             (such as io.BytesIO) where the image is
+    *             saved. By default 'path.png'.
     * Precondition: The path should be the shortest one
     *               between two points.
     * Return: -
     ----------------------------------------------------'''
+    # Coordinates of the nodes, computed when the igraph was built
+    coords = igraph.graph.get('node_coords')
+    if coords is None:
+        coords = {node: (igraph.nodes[node]['x'], igraph.nodes[node]['y']) for node in ipath}
+    # The adjacency of the graph is read directly, without the views that
+    # igraph[u] creates every time
+    adj = igraph._adj
     # Create a map of dimension (size x size)
-    path_map = StaticMap(size, size)
+    path_map = CachedStaticMap(size, size)
     # Will help to know if the beginning point has been put or not
     first = True
     for i in range(1, len(ipath)-1):
@@ -474,24 +1015,25 @@ def plot_path(igraph, ipath, size):
         # If it is the first point, mark it in blue color
         if first:
             first = False
-            marker = CircleMarker((igraph.nodes[ipath[i]]['x'], igraph.nodes[ipath[i]]['y']), 'blue', 15)
+            marker = CircleMarker(coords[ipath[i]], 'blue', 15)
         # Else mark it in the color of the congestion in that segment of
         # street and connect it to the previous point
         else:
-            for j in igraph[ipath[i-1]][ipath[i]]:
-                way = igraph[ipath[i-1]][ipath[i]][j]
+            ways = adj[ipath[i-1]][ipath[i]]
+            for j in ways:
+                way = ways[j]
                 congestion = way['congestion']
-                marker = CircleMarker((igraph.nodes[ipath[i-1]]['x'], igraph.nodes[ipath[i-1]]['y']), congestion_color(congestion), 5)
-                line = path_map.add_line(Line(((igraph.nodes[ipath[i-1]]['x'], igraph.nodes[ipath[i-1]]['y']), (igraph.nodes[ipath[i]]['x'], igraph.nodes[ipath[i]]['y'])), congestion_color(congestion), 3))
+                marker = CircleMarker(coords[ipath[i-1]], congestion_color(congestion), 5)
+                line = path_map.add_line(Line((coords[ipath[i-1]], coords[ipath[i]]), congestion_color(congestion), 3))
         path_map.add_marker(marker)
     # The last point will be marked in red
-    marker = CircleMarker((igraph.nodes[ipath[len(ipath)-1]]['x'], igraph.nodes[ipath[len(ipath)-1]]['y']), 'red', 15)
+    marker = CircleMarker(coords[ipath[len(ipath)-1]], 'red', 15)
     path_map.add_marker(marker)
     # Add a line from the last point to the previous one
-    line = path_map.add_line(Line(((igraph.nodes[ipath[len(ipath)-2]]['x'], igraph.nodes[ipath[len(ipath)-2]]['y']), (igraph.nodes[ipath[len(ipath)-1]]['x'], igraph.nodes[ipath[len(ipath)-1]]['y'])), 'red', 3))
-    # Construct the map and save it using the name 'path.png'
+    line = path_map.add_line(Line((coords[ipath[len(ipath)-2]], coords[ipath[len(ipath)-1]]), 'red', 3))
+    # Construct the map and save it as a PNG image in out
     image = path_map.render()
-    image.save('path.png')
+    image.save(out, 'PNG', optimize=False, compress_level=PNG_COMPRESS_LEVEL)
 
 
 def get_graph():
@@ -511,12 +1053,58 @@ def get_graph():
 
     return graph
 
+
+def save_igraph(igraph, file_name):
+    '''----------------------------------------------------
+    * Name: save_igraph
+    * Function: Saves an igraph in a file thanks to Pickle,
+    *           together with the time when it was saved.
+    * Parameters: igraph: Graph with congestion and itime
+    *             attributes we want to save.
+    *             file_name: Name of the file where we
+    *                        want to save the igraph.
+    * Return: -
+    ----------------------------------------------------'''
+    with open(file_name, 'wb', buffering=PICKLE_BUFFER_SIZE) as file:
+        pickle.dump((datetime.datetime.now(), igraph), file,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_igraph(file_name, max_age):
+    '''----------------------------------------------------
+    * Name: load_igraph
+    * Function: Loads an igraph from a file thanks to
+    *           Pickle if it is recent enough.
+    * Parameters: file_name: Name of the file from where
+    *             we want to load the igraph.
+    *             max_age: Maximum time (timedelta) that
+    *             can have passed since the igraph was
+    *             saved.
+    * Return: The igraph from the file given and the time
+    *         when it was saved, or (None, None) if the
+    *         file does not exist, it cannot be read or its
+    *         congestions are too old.
+    ----------------------------------------------------'''
+    if not exists_graph(file_name):
+        return None, None
+    try:
+        with open(file_name, 'rb', buffering=PICKLE_BUFFER_SIZE) as file:
+            save_time, igraph = pickle.load(file)
+    except Exception:
+        # If the file is broken, the igraph will be built again
+        return None, None
+    # The congestions of the igraph are too old
+    if datetime.datetime.now() - save_time > max_age:
+        return None, None
+    return igraph, save_time
+
+
 def update_graph(start_time, current_time, igraph, graph, highways, congestions):
     # Compares if more than 5 minuts have passed since the last update
     if (current_time - start_time > datetime.timedelta(minutes=5)):
         # Downloads the current congestions
         congestions = download_congestions(CONGESTIONS_URL)
-        # Creates a new igraph
-        igraph = build_igraph(graph, highways, congestions)
+        # Updates the igraph with the new congestions
+        igraph = update_igraph(igraph, highways, congestions)
 
     return igraph